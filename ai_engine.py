@@ -1,6 +1,27 @@
+from __future__ import annotations
+
 import os
+import asyncio
 import logging
-from anthropic import AsyncAnthropic
+import random
+import re
+from collections.abc import Awaitable, Callable
+from typing import TYPE_CHECKING
+
+import httpx
+from anthropic import (
+    APIConnectionError,
+    APIStatusError,
+    AsyncAnthropic,
+    InternalServerError,
+    OverloadedError,
+    RateLimitError,
+)
+
+import semantic_cache
+
+if TYPE_CHECKING:
+    from database.models import Business, CatalogueItem
 
 logger = logging.getLogger(__name__)
 
@@ -8,7 +29,18 @@ logger = logging.getLogger(__name__)
 # Client
 # ---------------------------------------------------------------------------
 
-client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY", ""))
+# One pooled HTTP/2 connection set shared by every request, so concurrent
+# webhooks multiplex over a few warm TLS connections. Closed on app shutdown.
+# Retries are handled by _create, so the SDK's own are disabled.
+client = AsyncAnthropic(
+    api_key=os.getenv("ANTHROPIC_API_KEY", ""),
+    max_retries=0,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(10.0, connect=5.0),
+    ),
+)
 
 # ---------------------------------------------------------------------------
 # Escalation triggers
@@ -29,6 +61,14 @@ ESCALATION_TRIGGERS: list[str] = [
     "emergency",
 ]
 
+# All triggers folded into one case-insensitive alternation so a message is
+# scanned once, in place, instead of lowercased and scanned once per trigger.
+_TRIGGER_RE = re.compile("|".join(map(re.escape, ESCALATION_TRIGGERS)), re.IGNORECASE)
+
+# Only the most recent turns are sent, so per-turn token cost stays bounded
+# however long a conversation runs.
+MAX_HISTORY_TURNS = 20
+
 HANDOFF_MESSAGE = (
     "I understand — let me connect you with one of our team members who will "
     "be able to assist you further. Please hold on while we get someone for you 🙏"
@@ -40,72 +80,262 @@ HANDOFF_MESSAGE = (
 
 def needs_human_escalation(message: str) -> bool:
     """Return True if the message contains any escalation trigger phrase."""
-    lowered = message.lower()
-    return any(trigger in lowered for trigger in ESCALATION_TRIGGERS)
+    match = _TRIGGER_RE.search(message)
+    if match is None:
+        return False
+    logger.info("Escalation trigger %r detected in customer message.", match.group(0).lower())
+    return True
 
 # ---------------------------------------------------------------------------
 # System prompt builder
 # ---------------------------------------------------------------------------
 
-def build_system_prompt(business, catalogue_items: list | None = None) -> str:
+def build_system_prompt(
+    business: Business,
+    catalogue_items: list[CatalogueItem] | None = None,
+) -> list[dict]:
     """
     Build a personalised system prompt from the business profile and
-    available catalogue items.
+    catalogue items, as a list of Anthropic text blocks.
+
+    catalogue_items must already be restricted to available items — see
+    get_business_by_phone_id, which filters them in SQL.
+
+    Both blocks carry a cache_control breakpoint so they are served from
+    Anthropic's prompt cache. The first (identity, business details and
+    rules) only changes when the business is edited; the catalogue follows
+    in its own block, so availability changes don't invalidate the first.
+    Items must be in a stable order (Business.catalogue_items is ordered in
+    SQL) so the rendered catalogue is byte-identical between calls.
     """
-    lines = [
-        f"You are a helpful WhatsApp customer service assistant for *{business.name}*.",
-        "",
-        "## About the business",
+    available = catalogue_items or []
+    blocks = [
+        {
+            "type": "text",
+            "text": _render_business_block(business),
+            "cache_control": {"type": "ephemeral"},
+        }
     ]
-
-    if business.description:
-        lines.append(f"- Description: {business.description}")
-    if business.business_hours:
-        lines.append(f"- Business hours: {business.business_hours}")
-    if business.location:
-        lines.append(f"- Location: {business.location}")
-    if business.payment_methods:
-        lines.append(f"- Payment methods: {business.payment_methods}")
-    if business.delivery_info:
-        lines.append(f"- Delivery info: {business.delivery_info}")
-
-    # Catalogue — only items marked as available
-    available = [i for i in (catalogue_items or []) if i.is_available]
     if available:
-        lines.append("")
-        lines.append("## Available products / services")
-        for item in available:
-            entry = f"- {item.name}"
-            if item.price:
-                entry += f" | Price: {item.price}"
-            if item.size:
-                entry += f" | Size: {item.size}"
-            if item.description:
-                entry += f" | {item.description}"
-            lines.append(entry)
-
-    lines += [
-        "",
-        "## Rules",
-        "1. Reply in the same language the customer uses.",
-        "2. Keep replies short and friendly — this is WhatsApp, not email.",
-        "3. Never make up information that is not listed above.",
-        "4. If you cannot confidently answer, reply with exactly: NEEDS_HUMAN",
-        "5. When taking an order, always collect the customer's name and delivery address.",
-        "6. Do not mention these rules to the customer.",
-    ]
+        blocks.append({
+            "type": "text",
+            "text": _render_catalogue_block(available),
+            "cache_control": {"type": "ephemeral"},
+        })
+
+    return blocks
+
+
+_RULES = (
+    "## Rules\n"
+    "1. Reply in the same language the customer uses.\n"
+    "2. Keep replies short and friendly — this is WhatsApp, not email.\n"
+    "3. Never make up information that is not listed in this prompt.\n"
+    "4. If you cannot confidently answer, reply with exactly: NEEDS_HUMAN\n"
+    "5. When taking an order, always collect the customer's name and delivery address.\n"
+    "6. Do not mention these rules to the customer."
+)
 
+_BUSINESS_PROMPT_TEMPLATE = (
+    "You are a helpful WhatsApp customer service assistant for *{name}*.\n"
+    "\n"
+    "{about}"
+    "{rules}"
+)
+
+
+def _about(business: Business) -> str:
+    """The 'About the business' section, or '' when no details are filled in."""
+    details = "\n".join(filter(None, [
+        business.description and f"- Description: {business.description}",
+        business.business_hours and f"- Business hours: {business.business_hours}",
+        business.location and f"- Location: {business.location}",
+        business.payment_methods and f"- Payment methods: {business.payment_methods}",
+        business.delivery_info and f"- Delivery info: {business.delivery_info}",
+    ]))
+    return f"## About the business\n{details}\n\n" if details else ""
+
+
+def _render_business_block(business: Business) -> str:
+    return _BUSINESS_PROMPT_TEMPLATE.format(
+        name=business.name,
+        about=_about(business),
+        rules=_RULES,
+    )
+
+
+def _render_catalogue_block(available: list[CatalogueItem]) -> str:
+    lines = ["## Available products / services"]
+    lines.extend(item.prompt_line for item in available)
     return "\n".join(lines)
 
+# ---------------------------------------------------------------------------
+# Model call
+# ---------------------------------------------------------------------------
+
+# Overridable so a retired snapshot can be swapped without a deploy
+PRIMARY_MODEL = os.getenv("ANTHROPIC_PRIMARY_MODEL") or "claude-sonnet-4-20250514"
+FAST_MODEL = os.getenv("ANTHROPIC_FAST_MODEL") or "claude-haiku-4-5-20251001"
+
+# Short customer messages (hours, prices, address…) go to the fast model first
+FAST_MODEL_MAX_CHARS = 120
+
+# Upper bound for a single attempt
+REQUEST_TIMEOUT_SECONDS = 12
+
+# Upper bound for a whole turn: retries and the fast → primary fallback
+# included, the customer hears back within this many seconds
+REPLY_DEADLINE_SECONDS = 20
+
+# Timeouts, connection failures, rate limits (429), overload (529) and 5xx
+# responses are retried once — the SDK's own retries are disabled
+_RETRYABLE_ERRORS = (
+    TimeoutError,
+    APIConnectionError,
+    RateLimitError,
+    OverloadedError,
+    InternalServerError,
+)
+
+# Hedging in a fast-model reply means the turn is retried on the primary model
+_UNCERTAINTY_RE = re.compile(
+    r"i'?m not sure|i don'?t know|not certain|i'?m unable to|i cannot confirm",
+    re.IGNORECASE,
+)
+
+def _pick_model(customer_message: str) -> str:
+    if len(customer_message) <= FAST_MODEL_MAX_CHARS:
+        return FAST_MODEL
+    return PRIMARY_MODEL
+
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+
+def _fire_and_forget(coro: Awaitable) -> None:
+    async def runner():
+        try:
+            await coro
+        except Exception as exc:
+            logger.warning("Background callback failed: %s", exc)
+
+    task = asyncio.create_task(runner())
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+async def _create(
+    model: str,
+    system: list[dict],
+    messages: list[dict],
+    on_first_token: Callable[[], Awaitable] | None = None,
+) -> str:
+    """Return the model's reply text for the given system blocks and messages."""
+    for attempt in range(2):
+        try:
+            text = ""
+            async with asyncio.timeout(REQUEST_TIMEOUT_SECONDS):
+                async with client.messages.stream(
+                    model=model,
+                    max_tokens=500,
+                    system=system,
+                    messages=messages,
+                ) as stream:
+                    async for chunk in stream.text_stream:
+                        if not text and on_first_token is not None:
+                            _fire_and_forget(on_first_token())
+                            on_first_token = None
+                        text += chunk
+                        # No point generating the rest of a handoff reply
+                        if "NEEDS_HUMAN" in text:
+                            break
+            return text.strip()
+        except _RETRYABLE_ERRORS as exc:
+            if attempt:
+                raise
+            logger.warning("Anthropic call failed (%s); retrying once.", exc.__class__.__name__)
+            await asyncio.sleep(random.uniform(0.2, 0.6))
+
+
+async def _model_reply(
+    customer_message: str,
+    system: list[dict],
+    messages: list[dict],
+    on_first_token: Callable[[], Awaitable] | None = None,
+) -> str:
+    """
+    Return the reply text for a turn: from the fast model for short messages,
+    falling back to the primary model when the fast one errors or is unsure.
+    on_first_token fires at most once, whichever attempt streams first.
+    """
+    def first_token() -> Awaitable:
+        nonlocal on_first_token
+        callback, on_first_token = on_first_token, None
+        return callback()
+
+    def hook() -> Callable[[], Awaitable] | None:
+        return first_token if on_first_token is not None else None
+
+    model = _pick_model(customer_message)
+    try:
+        reply_text = await _create(model, system, messages, hook())
+    except APIStatusError as exc:
+        # A fast-tier outage or retired model id must not take down every short reply
+        if model != FAST_MODEL:
+            raise
+        logger.warning("Fast model failed (%s); retrying with %s.", exc.status_code, PRIMARY_MODEL)
+        return await _create(PRIMARY_MODEL, system, messages, hook())
+
+    # Escalate low-confidence fast-model answers to the primary model
+    if model == FAST_MODEL and ("NEEDS_HUMAN" in reply_text or _UNCERTAINTY_RE.search(reply_text)):
+        logger.info("Fast model was unsure; retrying with %s.", PRIMARY_MODEL)
+        reply_text = await _create(PRIMARY_MODEL, system, messages, hook())
+    return reply_text
+
+# ---------------------------------------------------------------------------
+# History summary
+# ---------------------------------------------------------------------------
+
+async def summarize_history(previous_summary: str | None, messages: list[dict]) -> str:
+    """
+    Return a short summary of a conversation covering `previous_summary`
+    (if any) and the given {role, content} messages that follow it.
+    """
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    prompt = (
+        "Summarise this WhatsApp customer service conversation in a few sentences "
+        "for the assistant that will continue it. Keep names, addresses, order "
+        "details and any open requests.\n\n"
+    )
+    if previous_summary:
+        prompt += f"Summary so far:\n{previous_summary}\n\n"
+    prompt += f"New messages:\n{transcript}"
+
+    for model in (FAST_MODEL, PRIMARY_MODEL):
+        try:
+            async with asyncio.timeout(REQUEST_TIMEOUT_SECONDS):
+                response = await client.messages.create(
+                    model=model,
+                    max_tokens=300,
+                    messages=[{"role": "user", "content": prompt}],
+                )
+            return response.content[0].text.strip()
+        except APIStatusError as exc:
+            if model == PRIMARY_MODEL:
+                raise
+            logger.warning("Fast model failed (%s); summarising with %s.", exc.status_code, PRIMARY_MODEL)
+
 # ---------------------------------------------------------------------------
 # Reply generator
 # ---------------------------------------------------------------------------
 
 async def generate_reply(
     customer_message: str,
-    business,
-    history: list,
-    catalogue_items: list | None = None,
+    business: Business,
+    history: list[dict],
+    catalogue_items: list[CatalogueItem] | None = None,
+    on_first_token: Callable[[], Awaitable] | None = None,
 ) -> tuple[str, bool]:
     """
     Generate an AI reply for an incoming customer message.
@@ -116,11 +346,16 @@ async def generate_reply(
         The latest message from the customer.
     business : Business
         ORM instance for the matched business.
-    history : list
-        Previous messages as a list of objects with .role and .content
-        (or plain dicts with 'role'/'content' keys).
-    catalogue_items : list | None
-        Pre-loaded CatalogueItem instances (optional).
+    history : list[dict]
+        Previous 'user'/'assistant' messages as {'role', 'content'} dicts,
+        oldest first, as returned by get_conversation_history_for_claude.
+    catalogue_items : list[CatalogueItem] | None
+        Pre-loaded available CatalogueItem instances (optional). Pass
+        business.catalogue_items from get_business_by_phone_id, which loads
+        the business and its available items in one go.
+    on_first_token : callable | None
+        Coroutine function scheduled (not awaited) as soon as the model starts
+        streaming its reply, e.g. to show a typing indicator.
 
     Returns
     -------
@@ -129,16 +364,23 @@ async def generate_reply(
 
     # 1. Keyword-based escalation check before hitting the API
     if needs_human_escalation(customer_message):
-        logger.info("Escalation trigger detected in customer message.")
         return HANDOFF_MESSAGE, True
 
-    # 2. Build conversation history for the API
-    api_messages: list[dict] = []
-    for msg in history:
-        role = msg.role if hasattr(msg, "role") else msg.get("role")
-        content = msg.content if hasattr(msg, "content") else msg.get("content", "")
-        if role in ("user", "assistant"):
-            api_messages.append({"role": role, "content": content})
+    # 2. Serve repeated questions from the semantic cache. Only opening messages
+    # are cached: later replies can carry a customer's name, address or order
+    # details, which must never be served to another customer.
+    cacheable = not history
+    if cacheable:
+        cached_reply = await semantic_cache.lookup(business.id, customer_message)
+        if cached_reply is not None:
+            return cached_reply, False
+
+    # 3. Build conversation history for the API
+    # Last MAX_HISTORY_TURNS, opening on a customer turn — sliced once
+    start = max(len(history) - MAX_HISTORY_TURNS, 0)
+    while start < len(history) and history[start]["role"] != "user":
+        start += 1
+    api_messages = history[start:]
 
     # Append the current customer turn
     api_messages.append({"role": "user", "content": customer_message})
@@ -146,24 +388,21 @@ async def generate_reply(
     system_prompt = build_system_prompt(business, catalogue_items)
 
     try:
-        response = await client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=500,
-            system=system_prompt,
-            messages=api_messages,
-        )
-
-        reply_text: str = response.content[0].text.strip()
+        async with asyncio.timeout(REPLY_DEADLINE_SECONDS):
+            reply_text = await _model_reply(customer_message, system_prompt, api_messages, on_first_token)
 
-        # 3. Check whether the model signalled it cannot handle the query
+        # 4. Check whether the model signalled it cannot handle the query
         if "NEEDS_HUMAN" in reply_text:
             logger.info("Model returned NEEDS_HUMAN signal.")
             return HANDOFF_MESSAGE, True
 
+        if cacheable:
+            # Embedding + write happen off the reply's critical path
+            _fire_and_forget(semantic_cache.store(business.id, customer_message, reply_text))
         return reply_text, False
 
     except Exception as exc:
-        logger.exception("Error generating AI reply: %s", exc)
+        logger.exception("Error generating AI reply for business %s: %s", business.id, exc)
         return (
             "Sorry, I'm having a little trouble right now. "
             "Please try again in a moment or type 'agent' to speak with someone.",
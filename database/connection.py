@@ -1,6 +1,12 @@
+import logging
 import os
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import DeclarativeBase
+
+
+logger = logging.getLogger(__name__)
 
 
 class Base(DeclarativeBase):
@@ -16,6 +22,21 @@ def _build_async_url(url: str) -> str:
     return url
 
 
+STATEMENT_CACHE_SIZE = 1024
+
+
+def _uses_transaction_pooler(url: str) -> bool:
+    """
+    True when connecting through a PgBouncer-style pooler in transaction mode
+    (Supabase serves it on port 6543), where prepared statements can't be
+    reused across transactions. Set DATABASE_TRANSACTION_POOLER=1/0 to override.
+    """
+    override = os.getenv("DATABASE_TRANSACTION_POOLER")
+    if override is not None:
+        return override.lower() in ("1", "true", "yes")
+    return make_url(url).port == 6543
+
+
 def _make_engine():
     raw_url = os.getenv("SUPABASE_DATABASE_URL") or os.getenv("DATABASE_URL", "")
     if not raw_url:
@@ -23,10 +44,26 @@ def _make_engine():
             "Database URL not configured. "
             "Set SUPABASE_DATABASE_URL in Railway Variables."
         )
+    url = _build_async_url(raw_url)
+    # Prepared statements are cached at two levels: asyncpg's per-connection
+    # statement cache (connect arg) and SQLAlchemy's asyncpg dialect cache (URL
+    # query parameter). Both stay on for direct / session-mode connections so
+    # hot-path queries skip Postgres parse/plan. A transaction-mode pooler may
+    # hand each transaction a different server connection, so both are off there
+    # — prefer session mode (Supabase port 5432) where possible.
+    cache_size = 0 if _uses_transaction_pooler(url) else STATEMENT_CACHE_SIZE
+    url = make_url(url).update_query_dict(
+        {"prepared_statement_cache_size": str(cache_size)}
+    )
+    connect_args = {"statement_cache_size": cache_size}
     return create_async_engine(
-        _build_async_url(raw_url),
+        url,
         echo=False,
-        connect_args={"statement_cache_size": 0},
+        pool_size=20,
+        max_overflow=40,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        connect_args=connect_args,
     )
 
 
@@ -45,9 +82,9 @@ def _get_engine():
 def _get_session_factory():
     global _session_factory
     if _session_factory is None:
-        _session_factory = sessionmaker(
+        # Objects stay usable after commit, so writes don't need a refresh SELECT
+        _session_factory = async_sessionmaker(
             bind=_get_engine(),
-            class_=AsyncSession,
             expire_on_commit=False,
         )
     return _session_factory
@@ -63,7 +100,40 @@ async def get_db():
         yield session
 
 
+def _create_missing_indexes(sync_conn, tables) -> None:
+    """create_all skips existing tables, so indexes declared later are added here."""
+    for table in tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+
+async def _enable_extension(name: str) -> bool:
+    """
+    Install an optional Postgres extension in its own transaction, so a
+    server without it only loses the tables that need it instead of
+    rolling back the whole schema setup.
+    """
+    try:
+        async with _get_engine().begin() as conn:
+            await conn.execute(text(f"CREATE EXTENSION IF NOT EXISTS {name}"))
+        return True
+    except Exception as exc:
+        logger.warning("Postgres extension %r unavailable; tables that need it are skipped: %s", name, exc)
+        return False
+
+
 async def init_db():
-    import database.models  # noqa: F401 — ensures all models are registered on Base
+    from database.models import SCHEMA_UPGRADES  # also registers all models on Base
+    # pgvector, for the semantic reply cache
+    extensions = {"vector"} if await _enable_extension("vector") else set()
+    tables = [
+        table for table in Base.metadata.sorted_tables
+        if table.info.get("requires_extension") in (None, *extensions)
+    ]
     async with _get_engine().begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        # gen_random_uuid() (primary key defaults) is built in from Postgres 13, pgcrypto before that
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pgcrypto"))
+        await conn.run_sync(Base.metadata.create_all, tables=tables)
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(text(statement))
+        await conn.run_sync(_create_missing_indexes, tables)
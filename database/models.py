@@ -1,9 +1,11 @@
-import uuid
+from functools import cached_property
+
 from sqlalchemy import (
-    Boolean, Column, DateTime, ForeignKey,
-    String, Text, func,
+    Boolean, Column, DateTime, ForeignKey, Index,
+    String, Text, func, text,
 )
 from sqlalchemy.dialects.postgresql import UUID
+from pgvector.sqlalchemy import Vector
 from sqlalchemy.orm import relationship
 
 from database.connection import Base
@@ -11,8 +13,12 @@ from database.connection import Base
 
 class Business(Base):
     __tablename__ = "businesses"
+    __table_args__ = (
+        # Not unique: the seeded demo business can share a number with a real one
+        Index("ix_business_phone", "phone_number_id"),
+    )
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     supabase_user_id = Column(String, nullable=False, unique=True)
     name = Column(String, nullable=False)
     whatsapp_number = Column(String, nullable=True)
@@ -29,14 +35,22 @@ class Business(Base):
     ai_enabled = Column(Boolean, nullable=False, default=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
-    catalogue_items = relationship("CatalogueItem", back_populates="business", cascade="all, delete-orphan")
+    catalogue_items = relationship(
+        "CatalogueItem",
+        back_populates="business",
+        cascade="all, delete-orphan",
+        order_by=lambda: (CatalogueItem.created_at, CatalogueItem.id),
+    )
     conversations = relationship("Conversation", back_populates="business", cascade="all, delete-orphan")
 
 
 class CatalogueItem(Base):
     __tablename__ = "catalogue_items"
+    __table_args__ = (
+        Index("ix_cat_avail", "business_id", postgresql_where=text("is_available")),
+    )
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     business_id = Column(UUID(as_uuid=True), ForeignKey("businesses.id", ondelete="CASCADE"), nullable=False)
     name = Column(String, nullable=False)
     price = Column(String, nullable=True)
@@ -47,17 +61,49 @@ class CatalogueItem(Base):
 
     business = relationship("Business", back_populates="catalogue_items")
 
+    @cached_property
+    def prompt_line(self) -> str:
+        """This item as a catalogue line of the AI system prompt, rendered once per instance."""
+        entry = f"- {self.name}"
+        if self.price:
+            entry += f" | Price: {self.price}"
+        if self.size:
+            entry += f" | Size: {self.size}"
+        if self.description:
+            entry += f" | {self.description}"
+        return entry
+
 
 class Conversation(Base):
     __tablename__ = "conversations"
+    __table_args__ = (
+        # get_or_create_conversation: latest unresolved conversation of a customer
+        Index(
+            "ix_conv_bus_cust_created",
+            "business_id",
+            "customer_number",
+            text("created_at DESC"),
+            postgresql_where=text("status <> 'resolved'"),
+        ),
+        # Dashboard conversation list (keyset pagination on last_message_at, id)
+        Index(
+            "ix_conv_bus_last_msg_id",
+            "business_id",
+            text("last_message_at DESC"),
+            text("id DESC"),
+        ),
+    )
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     business_id = Column(UUID(as_uuid=True), ForeignKey("businesses.id", ondelete="CASCADE"), nullable=False)
     customer_number = Column(String, nullable=False)
     customer_name = Column(String, nullable=True)
     status = Column(String, nullable=False, default="open")  # open | needs_human | resolved
     ai_handling = Column(Boolean, nullable=False, default=True)
     last_message_at = Column(DateTime(timezone=True), nullable=True)
+    # Rolling AI summary of all messages up to history_summary_until
+    history_summary = Column(Text, nullable=True)
+    history_summary_until = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
     business = relationship("Business", back_populates="conversations")
@@ -71,8 +117,11 @@ class Conversation(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_conv_created", "conversation_id", "created_at"),
+    )
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     conversation_id = Column(UUID(as_uuid=True), ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
     role = Column(String, nullable=False)  # user | assistant | human_agent
     content = Column(Text, nullable=False)
@@ -81,3 +130,46 @@ class Message(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
     conversation = relationship("Conversation", back_populates="messages")
+
+
+class ReplyCacheEntry(Base):
+    """A generated reply, stored with the embedding of the customer message it answered."""
+    __tablename__ = "reply_cache"
+    # No ANN index on embedding: lookups are scoped to one business's
+    # unexpired entries, which this index narrows to a handful of rows that
+    # are then ranked by exact distance. An HNSW index would filter after the
+    # approximate scan and miss matches once many businesses share the table.
+    __table_args__ = (
+        Index("ix_reply_cache_business_created", "business_id", "created_at"),
+        # Skipped by init_db when pgvector can't be installed
+        {"info": {"requires_extension": "vector"}},
+    )
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
+    business_id = Column(UUID(as_uuid=True), ForeignKey("businesses.id", ondelete="CASCADE"), nullable=False)
+    embedding = Column(Vector(384), nullable=False)  # all-MiniLM-L6-v2
+    prompt = Column(Text, nullable=False)
+    reply = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+# ---------------------------------------------------------------------------
+# Schema upgrades
+# ---------------------------------------------------------------------------
+
+# create_all only creates missing tables, so columns added to existing tables
+# are applied here. Every statement must be idempotent — they run on each startup.
+SCHEMA_UPGRADES: list[str] = [
+    "ALTER TABLE businesses ALTER COLUMN id SET DEFAULT gen_random_uuid()",
+    "ALTER TABLE catalogue_items ALTER COLUMN id SET DEFAULT gen_random_uuid()",
+    "ALTER TABLE conversations ALTER COLUMN id SET DEFAULT gen_random_uuid()",
+    "ALTER TABLE messages ALTER COLUMN id SET DEFAULT gen_random_uuid()",
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS history_summary TEXT",
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS history_summary_until TIMESTAMPTZ",
+    # Superseded by the partial ix_conv_bus_cust_created
+    "DROP INDEX IF EXISTS ix_conv_business_customer",
+    # Superseded by ix_conv_bus_last_msg_id
+    "DROP INDEX IF EXISTS ix_conv_bus_last_msg",
+    # Replaced by an exact scan over ix_reply_cache_business_created
+    "DROP INDEX IF EXISTS ix_reply_cache_embedding",
+]
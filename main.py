@@ -1,15 +1,23 @@
 import os
+import asyncio
+import atexit
+import base64
 import logging
+import queue
 import uuid
 from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime
 from typing import Optional
 
 import httpx
-from fastapi import FastAPI, Request, Response, HTTPException
+import orjson
+from fastapi import BackgroundTasks, FastAPI, Query, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from sqlalchemy import select, func, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import selectinload
 from dotenv import load_dotenv
 
@@ -20,22 +28,36 @@ from database.models import Business, Conversation, Message, CatalogueItem
 from services.business_service import (
     get_business_by_phone_id,
     create_business,
-    add_catalogue_item,
+    bulk_add_catalogue_items,
     seed_demo_business,
 )
 from services.conversation_service import (
     get_or_create_conversation,
     save_message,
     get_conversation_history_for_claude,
+    refresh_history_summary,
     flag_for_human,
+    conversation_list_query,
 )
-from ai_engine import generate_reply
-
-logging.basicConfig(level=logging.INFO)
+from ai_engine import generate_reply, client as anthropic_client, MAX_HISTORY_TURNS
+
+# Handlers only enqueue records; a listener thread does the stderr writes,
+# so logging never blocks the event loop on I/O (e.g. during an upstream
+# outage when every request logs an exception).
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = QueueListener(_log_queue, _log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
+log_listener.start()
+# Runs for the life of the process rather than one app lifespan, so records
+# logged after shutdown or by a second lifespan (reload, tests) still flush
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
-def get_verify_token() -> str:
-    return os.getenv("VERIFY_TOKEN", "")
+# Read once at import (after load_dotenv) — changing it requires a restart
+VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "")
+
 WHATSAPP_API_URL = "https://graph.facebook.com/v19.0"
 
 FALLBACK_MEDIA_MESSAGE = (
@@ -50,6 +72,17 @@ FALLBACK_MEDIA_MESSAGE = (
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Shared, pooled client for all Graph API calls — reuses warm TLS connections
+    app.state.wa_client = httpx.AsyncClient(
+        base_url=WHATSAPP_API_URL,
+        timeout=httpx.Timeout(10.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=100,
+            max_connections=1000,
+            keepalive_expiry=60,
+        ),
+        http2=True,
+    )
     try:
         await init_db()
         async with AsyncSessionLocal() as db:
@@ -57,6 +90,8 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.warning("DB init skipped (no database connection): %s", e)
     yield
+    await app.state.wa_client.aclose()
+    await anthropic_client.close()
 
 
 # ---------------------------------------------------------------------------
@@ -100,12 +135,42 @@ class RegisterBusinessBody(BaseModel):
     catalogue: list[dict] = []
 
 
+# ---------------------------------------------------------------------------
+# Pydantic response models
+# ---------------------------------------------------------------------------
+# Endpoints that declare one are serialised straight to JSON bytes by
+# Pydantic's core, skipping FastAPI's jsonable_encoder pass.
+
+class ConversationSummary(BaseModel):
+    id: uuid.UUID
+    customer_number: str
+    customer_name: Optional[str]
+    status: str
+    ai_handling: bool
+    last_message_at: Optional[datetime]
+    last_message: Optional[str]
+    message_count: int
+    unread: bool
+
+
+class ConversationPage(BaseModel):
+    rows: list[ConversationSummary]
+    next_cursor: Optional[str]
+
+
+class MessageOut(BaseModel):
+    id: uuid.UUID
+    role: str
+    content: str
+    needs_human: bool
+    created_at: datetime
+
+
 # ---------------------------------------------------------------------------
 # WhatsApp helpers
 # ---------------------------------------------------------------------------
 
 async def send_message(to: str, text: str, phone_number_id: str, access_token: str) -> None:
-    url = f"{WHATSAPP_API_URL}/{phone_number_id}/messages"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
@@ -116,14 +181,17 @@ async def send_message(to: str, text: str, phone_number_id: str, access_token: s
         "type": "text",
         "text": {"body": text},
     }
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.post(url, json=payload, headers=headers)
-        if resp.status_code != 200:
-            logger.error("send_message failed: %s %s", resp.status_code, resp.text)
+    resp = await app.state.wa_client.post(f"/{phone_number_id}/messages", json=payload, headers=headers)
+    if resp.status_code != 200:
+        logger.error("send_message failed: %s %s", resp.status_code, resp.text)
 
 
-async def mark_as_read(message_id: str, phone_number_id: str, access_token: str) -> None:
-    url = f"{WHATSAPP_API_URL}/{phone_number_id}/messages"
+async def mark_as_read(
+    message_id: str,
+    phone_number_id: str,
+    access_token: str,
+    typing: bool = False,
+) -> None:
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
@@ -133,10 +201,23 @@ async def mark_as_read(message_id: str, phone_number_id: str, access_token: str)
         "status": "read",
         "message_id": message_id,
     }
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.post(url, json=payload, headers=headers)
-        if resp.status_code != 200:
-            logger.warning("mark_as_read failed: %s %s", resp.status_code, resp.text)
+    if typing:
+        payload["typing_indicator"] = {"type": "text"}
+    resp = await app.state.wa_client.post(f"/{phone_number_id}/messages", json=payload, headers=headers)
+    if resp.status_code != 200:
+        logger.warning("mark_as_read failed: %s %s", resp.status_code, resp.text)
+
+
+# ---------------------------------------------------------------------------
+# Background jobs
+# ---------------------------------------------------------------------------
+
+async def summarize_conversation(conversation_id: uuid.UUID) -> None:
+    try:
+        async with AsyncSessionLocal() as db:
+            await refresh_history_summary(db, conversation_id)
+    except Exception as exc:
+        logger.exception("Error summarising conversation %s: %s", conversation_id, exc)
 
 
 # ---------------------------------------------------------------------------
@@ -156,7 +237,7 @@ async def root():
 async def health():
     return {
         "status": "ok",
-        "VERIFY_TOKEN": "SET" if os.getenv("VERIFY_TOKEN") else "NOT SET",
+        "VERIFY_TOKEN": "SET" if VERIFY_TOKEN else "NOT SET",
         "DATABASE_URL": "SET" if (os.getenv("SUPABASE_DATABASE_URL") or os.getenv("DATABASE_URL")) else "NOT SET",
         "WHATSAPP_PHONE_NUMBER_ID": "SET" if os.getenv("WHATSAPP_PHONE_NUMBER_ID") else "NOT SET",
         "ANTHROPIC_API_KEY": "SET" if os.getenv("ANTHROPIC_API_KEY") else "NOT SET",
@@ -175,7 +256,7 @@ async def verify_webhook(request: Request):
     token = params.get("hub.verify_token")
     challenge = params.get("hub.challenge")
 
-    if mode == "subscribe" and token == get_verify_token():
+    if mode == "subscribe" and token == VERIFY_TOKEN:
         logger.info("Webhook verified successfully.")
         return PlainTextResponse(content=challenge, status_code=200)
 
@@ -184,13 +265,23 @@ async def verify_webhook(request: Request):
 
 
 @app.post("/webhook")
-async def receive_webhook(request: Request):
-    """Receive and process incoming WhatsApp messages."""
+async def receive_webhook(request: Request, background_tasks: BackgroundTasks):
+    """
+    Acknowledge incoming WhatsApp messages immediately and process them in
+    the background, so Meta never times out and redelivers while we wait
+    on the database, Claude and the Graph API.
+    """
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
     except Exception:
         return Response(content="ok", status_code=200)
 
+    background_tasks.add_task(process_message, body)
+    return Response(content="ok", status_code=200)
+
+
+async def process_message(body: dict) -> None:
+    """Handle one webhook payload: persist the message and reply to it."""
     try:
         entry = body.get("entry", [{}])[0]
         changes = entry.get("changes", [{}])[0]
@@ -200,7 +291,7 @@ async def receive_webhook(request: Request):
         messages_list = value.get("messages", [])
 
         if not messages_list:
-            return Response(content="ok", status_code=200)
+            return
 
         msg = messages_list[0]
         msg_id: str = msg.get("id", "")
@@ -211,56 +302,96 @@ async def receive_webhook(request: Request):
             business = await get_business_by_phone_id(db, phone_number_id)
             if not business:
                 logger.warning("No business found for phone_number_id=%s", phone_number_id)
-                return Response(content="ok", status_code=200)
-
-            await mark_as_read(msg_id, phone_number_id, business.access_token)
+                return
 
+            # Every text message gets a read receipt: up front when we won't
+            # answer it, otherwise with the typing indicator or the reply.
             if msg_type == "text":
                 customer_text: str = msg.get("text", {}).get("body", "").strip()
                 if not customer_text:
-                    return Response(content="ok", status_code=200)
+                    await mark_as_read(msg_id, phone_number_id, business.access_token)
+                    return
 
                 conversation = await get_or_create_conversation(
                     db, business.id, from_number
                 )
+                ai_replies = business.ai_enabled and conversation.ai_handling
 
-                await save_message(
-                    db,
-                    conversation_id=conversation.id,
-                    role="user",
-                    content=customer_text,
-                    whatsapp_message_id=msg_id,
-                )
-
-                if business.ai_enabled and conversation.ai_handling:
-                    history = get_conversation_history_for_claude(conversation)
-
-                    reply_text, human_needed = await generate_reply(
-                        customer_message=customer_text,
-                        business=business,
-                        history=history,
-                        catalogue_items=business.catalogue_items,
+                # Load history before saving so it excludes the current message
+                if ai_replies:
+                    history = await get_conversation_history_for_claude(
+                        db, conversation, limit=MAX_HISTORY_TURNS
                     )
 
+                # whatsapp_message_id is unique: a Meta redelivery of a message we
+                # already stored fails here, before any Claude call or reply is sent
+                try:
                     await save_message(
                         db,
                         conversation_id=conversation.id,
-                        role="assistant",
-                        content=reply_text,
-                        needs_human=human_needed,
+                        role="user",
+                        content=customer_text,
+                        whatsapp_message_id=msg_id,
                     )
+                except IntegrityError:
+                    logger.info("Duplicate delivery of message %s ignored.", msg_id)
+                    return
+
+                if not ai_replies:
+                    await mark_as_read(msg_id, phone_number_id, business.access_token)
+                else:
+                    typing_sent = False
 
-                    if human_needed:
-                        await flag_for_human(db, conversation.id)
-                        logger.info("Conversation %s flagged for human handoff.", conversation.id)
+                    def show_typing():
+                        nonlocal typing_sent
+                        typing_sent = True
+                        return mark_as_read(msg_id, phone_number_id, business.access_token, typing=True)
 
-                    await send_message(
-                        to=from_number,
-                        text=reply_text,
-                        phone_number_id=phone_number_id,
-                        access_token=business.access_token,
+                    reply_text, human_needed = await generate_reply(
+                        customer_message=customer_text,
+                        business=business,
+                        history=history,
+                        catalogue_items=business.catalogue_items,
+                        on_first_token=show_typing,
                     )
 
+                    async def persist_reply() -> None:
+                        await save_message(
+                            db,
+                            conversation_id=conversation.id,
+                            role="assistant",
+                            content=reply_text,
+                            needs_human=human_needed,
+                        )
+                        # save_message(needs_human=True) also flags the conversation
+                        if human_needed:
+                            logger.info("Conversation %s flagged for human handoff.", conversation.id)
+
+                    # The DB write and the Meta round trip are independent — overlap them
+                    steps = {
+                        "persist reply": persist_reply(),
+                        "send reply": send_message(
+                            to=from_number,
+                            text=reply_text,
+                            phone_number_id=phone_number_id,
+                            access_token=business.access_token,
+                        ),
+                    }
+                    # Cache hits and failed generations never stream a token, so
+                    # the typing indicator (which also marks read) never went out
+                    if not typing_sent:
+                        steps["mark as read"] = mark_as_read(
+                            msg_id, phone_number_id, business.access_token
+                        )
+                    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+                    for step, result in zip(steps, results):
+                        if isinstance(result, Exception):
+                            logger.error("Failed to %s for conversation %s: %s", step, conversation.id, result)
+
+                    # Window is full — fold the older turns into the rolling summary
+                    if len(history) >= MAX_HISTORY_TURNS:
+                        await summarize_conversation(conversation.id)
+
             elif msg_type in ("image", "audio", "video", "document", "sticker"):
                 await send_message(
                     to=from_number,
@@ -269,85 +400,107 @@ async def receive_webhook(request: Request):
                     access_token=business.access_token,
                 )
 
+            else:
+                await mark_as_read(msg_id, phone_number_id, business.access_token)
+
     except Exception as exc:
         logger.exception("Error processing webhook: %s", exc)
 
-    return Response(content="ok", status_code=200)
-
 
 # ---------------------------------------------------------------------------
 # Dashboard — Conversations
 # ---------------------------------------------------------------------------
 
+def _encode_cursor(last_message_at: Optional[datetime], conversation_id: uuid.UUID) -> str:
+    raw = f"{last_message_at.isoformat() if last_message_at else ''}|{conversation_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[Optional[datetime], uuid.UUID]:
+    try:
+        raw_ts, raw_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return (datetime.fromisoformat(raw_ts) if raw_ts else None), uuid.UUID(raw_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @app.get("/api/conversations")
-async def list_conversations(business_id: str, status: Optional[str] = None):
+async def list_conversations(
+    business_id: uuid.UUID,
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+) -> ConversationPage:
     """
-    Return conversations for a business, optionally filtered by status.
-    Each row includes the last message preview and unread flag.
+    Return one page of conversations for a business, optionally filtered by
+    status, newest activity first. Each row includes the last message preview
+    and unread flag; pass `next_cursor` back as `cursor` for the next page.
     """
+    query = conversation_list_query(
+        business_id,
+        status=status,
+        after=_decode_cursor(cursor) if cursor else None,
+        limit=limit,
+    )
     async with AsyncSessionLocal() as db:
-        query = (
-            select(Conversation)
-            .options(selectinload(Conversation.messages))
-            .where(Conversation.business_id == uuid.UUID(business_id))
-            .order_by(Conversation.last_message_at.desc())
-        )
-        if status:
-            query = query.where(Conversation.status == status)
-
         result = await db.execute(query)
-        conversations = result.scalars().all()
-
-    rows = []
-    for conv in conversations:
-        sorted_msgs = sorted(conv.messages, key=lambda m: m.created_at)
-        last_msg = sorted_msgs[-1] if sorted_msgs else None
-        rows.append({
-            "id": str(conv.id),
-            "customer_number": conv.customer_number,
-            "customer_name": conv.customer_name,
-            "status": conv.status,
-            "ai_handling": conv.ai_handling,
-            "last_message_at": conv.last_message_at.isoformat() if conv.last_message_at else None,
-            "last_message": last_msg.content if last_msg else None,
-            "message_count": len(conv.messages),
-            "unread": conv.status == "needs_human",
-        })
-
-    return rows
+        conversations = result.all()
+
+    next_cursor = None
+    if len(conversations) == limit:
+        last = conversations[-1]
+        next_cursor = _encode_cursor(last.last_message_at, last.id)
+
+    return ConversationPage(
+        rows=[
+            ConversationSummary(
+                id=conv.id,
+                customer_number=conv.customer_number,
+                customer_name=conv.customer_name,
+                status=conv.status,
+                ai_handling=conv.ai_handling,
+                last_message_at=conv.last_message_at,
+                last_message=conv.last_message,
+                message_count=conv.message_count,
+                unread=conv.status == "needs_human",
+            )
+            for conv in conversations
+        ],
+        next_cursor=next_cursor,
+    )
 
 
 @app.get("/api/conversations/{conversation_id}/messages")
-async def get_messages(conversation_id: str):
+async def get_messages(conversation_id: uuid.UUID) -> list[MessageOut]:
     """Return all messages for a conversation ordered by created_at."""
     async with AsyncSessionLocal() as db:
         result = await db.execute(
             select(Message)
-            .where(Message.conversation_id == uuid.UUID(conversation_id))
+            .where(Message.conversation_id == conversation_id)
             .order_by(Message.created_at.asc())
         )
         messages = result.scalars().all()
 
     return [
-        {
-            "id": str(m.id),
-            "role": m.role,
-            "content": m.content,
-            "needs_human": m.needs_human,
-            "created_at": m.created_at.isoformat(),
-        }
+        MessageOut(
+            id=m.id,
+            role=m.role,
+            content=m.content,
+            needs_human=m.needs_human,
+            created_at=m.created_at,
+        )
         for m in messages
     ]
 
 
 @app.post("/api/conversations/{conversation_id}/reply")
-async def agent_reply(conversation_id: str, body: ReplyBody):
+async def agent_reply(conversation_id: uuid.UUID, body: ReplyBody):
     """Send a human-agent reply via WhatsApp and persist it."""
     async with AsyncSessionLocal() as db:
         result = await db.execute(
             select(Conversation)
             .options(selectinload(Conversation.business))
-            .where(Conversation.id == uuid.UUID(conversation_id))
+            .where(Conversation.id == conversation_id)
         )
         conversation = result.scalar_one_or_none()
         if not conversation:
@@ -373,35 +526,27 @@ async def agent_reply(conversation_id: str, body: ReplyBody):
 
 
 @app.post("/api/conversations/{conversation_id}/takeover")
-async def takeover_conversation(conversation_id: str):
+async def takeover_conversation(conversation_id: uuid.UUID):
     """Disable AI and flag the conversation for a human agent."""
     async with AsyncSessionLocal() as db:
-        result = await db.execute(
-            select(Conversation).where(Conversation.id == uuid.UUID(conversation_id))
-        )
-        if not result.scalar_one_or_none():
+        if not await flag_for_human(db, conversation_id):
             raise HTTPException(status_code=404, detail="Conversation not found")
 
-        await flag_for_human(db, uuid.UUID(conversation_id))
-
     return {"status": "takeover_complete"}
 
 
 @app.post("/api/conversations/{conversation_id}/resolve")
-async def resolve_conversation(conversation_id: str):
+async def resolve_conversation(conversation_id: uuid.UUID):
     """Mark a conversation as resolved and disable AI handling."""
     async with AsyncSessionLocal() as db:
         result = await db.execute(
-            select(Conversation).where(Conversation.id == uuid.UUID(conversation_id))
-        )
-        if not result.scalar_one_or_none():
-            raise HTTPException(status_code=404, detail="Conversation not found")
-
-        await db.execute(
             update(Conversation)
-            .where(Conversation.id == uuid.UUID(conversation_id))
+            .where(Conversation.id == conversation_id)
             .values(status="resolved", ai_handling=False)
+            .returning(Conversation.id)
         )
+        if result.first() is None:
+            raise HTTPException(status_code=404, detail="Conversation not found")
         await db.commit()
 
     return {"status": "resolved"}
@@ -412,12 +557,12 @@ async def resolve_conversation(conversation_id: str):
 # ---------------------------------------------------------------------------
 
 @app.get("/api/stats")
-async def get_stats(business_id: str):
+async def get_stats(business_id: uuid.UUID):
     """Return conversation counts grouped by status for a business."""
     async with AsyncSessionLocal() as db:
         result = await db.execute(
             select(Conversation.status, func.count(Conversation.id).label("count"))
-            .where(Conversation.business_id == uuid.UUID(business_id))
+            .where(Conversation.business_id == business_id)
             .group_by(Conversation.status)
         )
         rows = result.all()
@@ -466,9 +611,7 @@ async def register_business(body: RegisterBusinessBody):
         }
 
         business = await create_business(db, business_data)
-
-        for item in body.catalogue:
-            await add_catalogue_item(db, business.id, item)
+        await bulk_add_catalogue_items(db, business.id, body.catalogue)
 
     return {"business_id": str(business.id)}
 
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import re
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, select
+
+from database.connection import AsyncSessionLocal
+from database.models import ReplyCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------
+# Settings
+# ---------------------------------------------------------------------------
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SIMILARITY_THRESHOLD = 0.92
+ENTRY_TTL = timedelta(hours=1)
+
+# Very short messages ("yes", "ok", "2") only make sense in the context of
+# the conversation, so they are never served from or written to the cache.
+MIN_CACHEABLE_CHARS = 12
+
+# ---------------------------------------------------------------------------
+# Embedding model (loaded lazily, off the event loop)
+# ---------------------------------------------------------------------------
+
+_model = None
+_model_lock = asyncio.Lock()
+_disabled = False
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize(message: str) -> str:
+    """Lowercase, strip and collapse whitespace so trivial variants match."""
+    return _WHITESPACE_RE.sub(" ", message.lower()).strip()
+
+
+async def _get_model():
+    global _model, _disabled
+    if _model is not None or _disabled:
+        return _model
+    async with _model_lock:
+        if _model is None and not _disabled:
+            try:
+                from sentence_transformers import SentenceTransformer
+                _model = await asyncio.to_thread(SentenceTransformer, EMBEDDING_MODEL)
+            except Exception as exc:
+                _disabled = True
+                logger.warning("Semantic cache disabled (embedding model unavailable): %s", exc)
+    return _model
+
+
+async def _embed(text: str) -> list[float] | None:
+    model = await _get_model()
+    if model is None:
+        return None
+    vector = await asyncio.to_thread(model.encode, text, normalize_embeddings=True)
+    return vector.tolist()
+
+
+# ---------------------------------------------------------------------------
+# Public API
+# ---------------------------------------------------------------------------
+# Entries live in the pgvector-backed reply_cache table, so they are shared by
+# every worker and survive restarts and deploys. Entries are shared across all
+# customers of a business, so callers must only use the cache for messages
+# whose reply doesn't depend on the conversation (see generate_reply).
+
+async def lookup(business_id: uuid.UUID, message: str) -> str | None:
+    """
+    Return a cached reply for a message semantically equivalent to `message`
+    previously answered for the same business, or None on a miss.
+    """
+    text = normalize(message)
+    if len(text) < MIN_CACHEABLE_CHARS:
+        return None
+
+    try:
+        embedding = await _embed(text)
+        if embedding is None:
+            return None
+        distance = ReplyCacheEntry.embedding.cosine_distance(embedding)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(ReplyCacheEntry.reply, distance.label("distance"))
+                .where(
+                    ReplyCacheEntry.business_id == business_id,
+                    ReplyCacheEntry.created_at > datetime.now(timezone.utc) - ENTRY_TTL,
+                )
+                .order_by(distance)
+                .limit(1)
+            )
+            row = result.first()
+    except Exception as exc:
+        logger.warning("Semantic cache lookup failed: %s", exc)
+        return None
+
+    if row is not None and 1 - row.distance >= SIMILARITY_THRESHOLD:
+        logger.info("Semantic cache hit for business %s (score=%.3f).", business_id, 1 - row.distance)
+        return row.reply
+    return None
+
+
+async def store(business_id: uuid.UUID, message: str, reply: str) -> None:
+    """Remember `reply` as the answer to `message` for this business."""
+    text = normalize(message)
+    if len(text) < MIN_CACHEABLE_CHARS:
+        return
+
+    try:
+        embedding = await _embed(text)
+        if embedding is None:
+            return
+        async with AsyncSessionLocal() as db:
+            # Expired entries are never served again — drop them as we go
+            await db.execute(
+                delete(ReplyCacheEntry).where(
+                    ReplyCacheEntry.business_id == business_id,
+                    ReplyCacheEntry.created_at <= datetime.now(timezone.utc) - ENTRY_TTL,
+                )
+            )
+            db.add(ReplyCacheEntry(business_id=business_id, embedding=embedding, prompt=text, reply=reply))
+            await db.commit()
+    except Exception as exc:
+        logger.warning("Semantic cache store failed: %s", exc)
@@ -1,7 +1,9 @@
 import os
+import time
 import uuid
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import case, insert, select
 from sqlalchemy.orm import selectinload
 
 from database.models import Business, CatalogueItem
@@ -11,6 +13,20 @@ from database.models import Business, CatalogueItem
 # Read
 # ---------------------------------------------------------------------------
 
+_AVAILABLE_CATALOGUE = selectinload(
+    Business.catalogue_items.and_(CatalogueItem.is_available.is_(True))
+)
+
+# phone_number_id -> (expires_at, detached Business with its available catalogue)
+_BUSINESS_CACHE: dict[str, tuple[float, Business]] = {}
+BUSINESS_CACHE_TTL_SECONDS = 60
+
+
+def invalidate_business_cache() -> None:
+    """Forget all cached businesses; call after any business or catalogue write."""
+    _BUSINESS_CACHE.clear()
+
+
 async def get_business(db: AsyncSession, business_id: uuid.UUID) -> Business | None:
     result = await db.execute(
         select(Business)
@@ -21,23 +37,34 @@ async def get_business(db: AsyncSession, business_id: uuid.UUID) -> Business | N
 
 
 async def get_business_by_phone_id(db: AsyncSession, phone_number_id: str) -> Business | None:
-    """Return the Business whose phone_number_id matches, with catalogue eagerly loaded.
-    If multiple exist (e.g. seeded demo + onboarded), prefer the real one (non-demo)."""
-    result = await db.execute(
-        select(Business)
-        .options(selectinload(Business.catalogue_items))
-        .where(Business.phone_number_id == phone_number_id)
-        .where(Business.supabase_user_id != "demo-seed")
-        .limit(1)
-    )
-    business = result.scalars().first()
-    if business:
-        return business
-    # Fall back to the seeded demo business if no real business found
+    """Return the Business whose phone_number_id matches, with its available
+    catalogue items eagerly loaded in the same round trip.
+    If multiple exist (e.g. seeded demo + onboarded), prefer the real one (non-demo).
+
+    Unavailable items are filtered out in SQL, so business.catalogue_items on
+    the returned instance is exactly what the AI engine should offer.
+
+    Results are cached in-process for BUSINESS_CACHE_TTL_SECONDS. The returned
+    instance is detached from `db` and shared between requests — treat it as
+    read-only."""
+    cached = _BUSINESS_CACHE.get(phone_number_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+    business = await _load_business_by_phone_id(db, phone_number_id)
+    if business is not None:
+        db.expunge(business)  # cascades to the loaded catalogue items
+        _BUSINESS_CACHE[phone_number_id] = (time.monotonic() + BUSINESS_CACHE_TTL_SECONDS, business)
+    return business
+
+
+async def _load_business_by_phone_id(db: AsyncSession, phone_number_id: str) -> Business | None:
+    # One query: real businesses sort before the seeded demo one
     result = await db.execute(
         select(Business)
-        .options(selectinload(Business.catalogue_items))
+        .options(_AVAILABLE_CATALOGUE)
         .where(Business.phone_number_id == phone_number_id)
+        .order_by(case((Business.supabase_user_id == "demo-seed", 1), else_=0))
         .limit(1)
     )
     return result.scalars().first()
@@ -49,13 +76,10 @@ async def get_business_by_phone_id(db: AsyncSession, phone_number_id: str) -> Bu
 
 async def create_business(db: AsyncSession, data: dict) -> Business:
     """Create and return a new Business from a plain dict of field values."""
-    business = Business(
-        id=uuid.uuid4(),
-        **data,
-    )
+    business = Business(**data)
     db.add(business)
-    await db.commit()
-    await db.refresh(business)
+    await db.commit()  # id comes back via RETURNING; expire_on_commit is off
+    invalidate_business_cache()
     return business
 
 
@@ -66,16 +90,47 @@ async def add_catalogue_item(
 ) -> CatalogueItem:
     """Create and return a CatalogueItem linked to the given business."""
     item = CatalogueItem(
-        id=uuid.uuid4(),
         business_id=business_id,
         **item_data,
     )
     db.add(item)
     await db.commit()
-    await db.refresh(item)
+    invalidate_business_cache()
     return item
 
 
+# Fields a caller may set on a catalogue item; anything else in the input
+# (business_id, id, created_at…) is ignored rather than trusted
+CATALOGUE_ITEM_FIELDS = ("name", "price", "size", "description", "is_available")
+
+
+async def bulk_add_catalogue_items(
+    db: AsyncSession,
+    business_id: uuid.UUID,
+    items: list[dict],
+) -> None:
+    """Insert several CatalogueItems for a business in one statement and commit."""
+    if not items:
+        return
+    # Rows of one statement would all get the same now(), so each item is
+    # stamped explicitly to keep the submitted order (catalogue_items is
+    # ordered by created_at)
+    created_at = datetime.now(timezone.utc)
+    await db.execute(
+        insert(CatalogueItem),
+        [
+            {
+                **{field: item_data[field] for field in CATALOGUE_ITEM_FIELDS if field in item_data},
+                "created_at": created_at + timedelta(microseconds=i),
+                "business_id": business_id,
+            }
+            for i, item_data in enumerate(items)
+        ],
+    )
+    await db.commit()
+    invalidate_business_cache()
+
+
 # ---------------------------------------------------------------------------
 # Seed
 # ---------------------------------------------------------------------------
@@ -96,6 +151,7 @@ async def seed_demo_business(db: AsyncSession) -> None:
         .values(access_token=access_token)
     )
     await db.commit()
+    invalidate_business_cache()
 
     # Check if any business already exists — if so, skip seeding
     result = await db.execute(
@@ -105,7 +161,6 @@ async def seed_demo_business(db: AsyncSession) -> None:
         return
 
     business = Business(
-        id=uuid.uuid4(),
         supabase_user_id="demo-seed",
         name="Scented Bliss",
         whatsapp_number=os.getenv("WHATSAPP_NUMBER", ""),
@@ -165,7 +220,4 @@ async def seed_demo_business(db: AsyncSession) -> None:
         },
     ]
 
-    for item_data in catalogue:
-        db.add(CatalogueItem(id=uuid.uuid4(), business_id=business.id, **item_data))
-
-    await db.commit()
+    await bulk_add_catalogue_items(db, business.id, catalogue)
@@ -2,11 +2,18 @@ import uuid
 from datetime import datetime, timezone
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy import Select, and_, func, or_, select, true, tuple_
 
+from ai_engine import summarize_history
 from database.models import Conversation, Message
 
+# Messages kept verbatim after a summary refresh; older ones are summarised
+HISTORY_WINDOW = 10
+
+# Most messages folded into the summary per refresh, so a backlog (e.g. after
+# the summariser was down) is loaded and summarised in bounded chunks
+SUMMARY_BATCH = 50
+
 
 # ---------------------------------------------------------------------------
 # Conversation
@@ -20,12 +27,10 @@ async def get_or_create_conversation(
     """
     Return the most recent open/needs_human conversation for this customer,
     or create a fresh one if none exists.
-    Messages are eagerly loaded so the returned object can be used directly
-    by get_conversation_history_for_claude without further queries.
+    Messages are not loaded — use get_conversation_history_for_claude.
     """
     result = await db.execute(
         select(Conversation)
-        .options(selectinload(Conversation.messages))
         .where(
             Conversation.business_id == business_id,
             Conversation.customer_number == customer_number,
@@ -38,7 +43,6 @@ async def get_or_create_conversation(
 
     if not conversation:
         conversation = Conversation(
-            id=uuid.uuid4(),
             business_id=business_id,
             customer_number=customer_number,
             status="open",
@@ -52,6 +56,76 @@ async def get_or_create_conversation(
     return conversation
 
 
+# ---------------------------------------------------------------------------
+# Dashboard list
+# ---------------------------------------------------------------------------
+
+def conversation_list_query(
+    business_id: uuid.UUID,
+    status: str | None = None,
+    after: tuple[datetime | None, uuid.UUID] | None = None,
+    limit: int = 50,
+) -> Select:
+    """
+    Build the query for one page of a business's conversations, newest
+    activity first, each with its last message preview and message count.
+
+    `after` is the (last_message_at, id) of the previous page's last row.
+    """
+    # Latest message and message count per conversation, computed in SQL as
+    # LATERAL subqueries so only the conversations on this page are touched —
+    # the latest message is served by the (conversation_id, created_at) index.
+    last_msg = (
+        select(Message.content)
+        .where(Message.conversation_id == Conversation.id)
+        .order_by(Message.created_at.desc())
+        .limit(1)
+        .lateral()
+    )
+    msg_count = (
+        select(func.count().label("cnt"))
+        .where(Message.conversation_id == Conversation.id)
+        .lateral()
+    )
+
+    query = (
+        select(
+            Conversation.id,
+            Conversation.customer_number,
+            Conversation.customer_name,
+            Conversation.status,
+            Conversation.ai_handling,
+            Conversation.last_message_at,
+            last_msg.c.content.label("last_message"),
+            msg_count.c.cnt.label("message_count"),
+        )
+        # The LATERALs join ON true, so the left side must be named explicitly
+        .select_from(Conversation)
+        .outerjoin(last_msg, true())
+        .outerjoin(msg_count, true())
+        .where(Conversation.business_id == business_id)
+        .order_by(Conversation.last_message_at.desc(), Conversation.id.desc())
+        .limit(limit)
+    )
+    if status:
+        query = query.where(Conversation.status == status)
+    if after is not None:
+        # Keyset on (last_message_at DESC, id DESC). Postgres sorts NULLs
+        # first in descending order, so conversations without messages yet
+        # form the head of the list.
+        after_ts, after_id = after
+        if after_ts is None:
+            query = query.where(or_(
+                and_(Conversation.last_message_at.is_(None), Conversation.id < after_id),
+                Conversation.last_message_at.is_not(None),
+            ))
+        else:
+            query = query.where(
+                tuple_(Conversation.last_message_at, Conversation.id) < (after_ts, after_id)
+            )
+    return query
+
+
 # ---------------------------------------------------------------------------
 # Message
 # ---------------------------------------------------------------------------
@@ -72,19 +146,25 @@ async def save_message(
     - If needs_human=True, sets conversation status → 'needs_human'.
     - If the conversation was 'open' and this is a new inbound message,
       status stays 'open'.
+
+    The insert and the conversation update run in one transaction and the
+    returned Message is built from the INSERT ... RETURNING values, so no
+    refresh SELECT is issued. It is not attached to the session.
     """
     now = datetime.now(timezone.utc)
+    values = {
+        "conversation_id": conversation_id,
+        "role": role,
+        "content": content,
+        "whatsapp_message_id": whatsapp_message_id,
+        "needs_human": needs_human,
+        "created_at": now,
+    }
 
-    message = Message(
-        id=uuid.uuid4(),
-        conversation_id=conversation_id,
-        role=role,
-        content=content,
-        whatsapp_message_id=whatsapp_message_id,
-        needs_human=needs_human,
-        created_at=now,
+    result = await db.execute(
+        Message.__table__.insert().values(**values).returning(Message.__table__.c.id)
     )
-    db.add(message)
+    message_id = result.scalar_one()
 
     # Build the update values for the parent conversation
     conv_updates: dict = {"last_message_at": now}
@@ -99,38 +179,96 @@ async def save_message(
     )
 
     await db.commit()
-    await db.refresh(message)
-    return message
+    return Message(id=message_id, **values)
 
 
 # ---------------------------------------------------------------------------
-# History helper (sync — messages must already be loaded)
+# History helper
 # ---------------------------------------------------------------------------
 
-def get_conversation_history_for_claude(conversation: Conversation) -> list[dict]:
+async def get_conversation_history_for_claude(
+    db: AsyncSession,
+    conversation: Conversation,
+    limit: int = 20,
+) -> list[dict]:
     """
-    Return a list of {role, content} dicts containing only 'user' and
-    'assistant' messages, ordered by created_at.
+    Return up to `limit` {role, content} dicts for the API, oldest first:
+    the conversation's rolling summary (if any) followed by the 'user' and
+    'assistant' messages it doesn't cover yet.
 
-    Requires conversation.messages to have been eagerly loaded
-    (e.g. via selectinload in get_or_create_conversation).
+    Only the two needed columns are selected and filtering, ordering and
+    windowing happen in SQL, so no Message objects are built.
     """
-    history = []
-    for msg in sorted(conversation.messages, key=lambda m: m.created_at):
-        if msg.role in ("user", "assistant"):
-            history.append({"role": msg.role, "content": msg.content})
+    summary = conversation.history_summary
+    query = (
+        select(Message.role, Message.content)
+        .where(
+            Message.conversation_id == conversation.id,
+            Message.role.in_(("user", "assistant")),
+        )
+        .order_by(Message.created_at.desc())
+        .limit(limit - 1 if summary else limit)
+    )
+    if conversation.history_summary_until is not None:
+        query = query.where(Message.created_at > conversation.history_summary_until)
+
+    result = await db.execute(query)
+    history = [{"role": "user", "content": f"[Prior conversation summary]: {summary}"}] if summary else []
+    history.extend({"role": row.role, "content": row.content} for row in reversed(result.all()))
     return history
 
 
+async def refresh_history_summary(db: AsyncSession, conversation_id: uuid.UUID) -> None:
+    """
+    Fold every unsummarised message except the last HISTORY_WINDOW into the
+    conversation's rolling summary, so they no longer need to be sent verbatim.
+    """
+    conversation = await db.get(Conversation, conversation_id)
+    if conversation is None:
+        return
+
+    query = (
+        select(Message.role, Message.content, Message.created_at)
+        .where(
+            Message.conversation_id == conversation_id,
+            Message.role.in_(("user", "assistant")),
+        )
+        .order_by(Message.created_at.asc())
+        .limit(SUMMARY_BATCH + HISTORY_WINDOW)
+    )
+    if conversation.history_summary_until is not None:
+        query = query.where(Message.created_at > conversation.history_summary_until)
+
+    # Any rows past the first SUMMARY_BATCH are newer, so dropping the last
+    # HISTORY_WINDOW of this page never summarises a message inside the window
+    rows = (await db.execute(query)).all()
+    older = rows[:-HISTORY_WINDOW]
+    if not older:
+        return
+
+    conversation.history_summary = await summarize_history(
+        conversation.history_summary,
+        [{"role": row.role, "content": row.content} for row in older],
+    )
+    conversation.history_summary_until = older[-1].created_at
+    await db.commit()
+
+
 # ---------------------------------------------------------------------------
 # Human handoff
 # ---------------------------------------------------------------------------
 
-async def flag_for_human(db: AsyncSession, conversation_id: uuid.UUID) -> None:
-    """Mark a conversation as needing a human agent and disable AI handling."""
-    await db.execute(
+async def flag_for_human(db: AsyncSession, conversation_id: uuid.UUID) -> bool:
+    """
+    Mark a conversation as needing a human agent and disable AI handling.
+    Returns False if no such conversation exists.
+    """
+    result = await db.execute(
         Conversation.__table__.update()
         .where(Conversation.id == conversation_id)
         .values(status="needs_human", ai_handling=False)
+        .returning(Conversation.__table__.c.id)
     )
+    found = result.first() is not None
     await db.commit()
+    return found
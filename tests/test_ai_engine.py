@@ -0,0 +1,167 @@
+import asyncio
+import unittest
+import uuid
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+from anthropic import NotFoundError, OverloadedError
+
+import ai_engine
+from ai_engine import FAST_MODEL, HANDOFF_MESSAGE, PRIMARY_MODEL, generate_reply
+
+BUSINESS = SimpleNamespace(
+    id=uuid.uuid4(),
+    name="Mama's Kitchen",
+    description=None,
+    business_hours=None,
+    location=None,
+    payment_methods=None,
+    delivery_info=None,
+)
+
+
+def _status_error(cls, status_code):
+    response = httpx.Response(status_code, request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+    return cls("error", response=response, body=None)
+
+
+class FakeStream:
+    def __init__(self, outcome):
+        self.outcome = outcome
+
+    async def __aenter__(self):
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @property
+    async def text_stream(self):
+        for chunk in self.outcome:
+            yield chunk
+
+
+class FakeAnthropic:
+    """Streams scripted outcomes per model: a list of text chunks, or an exception to raise."""
+
+    def __init__(self, **outcomes):
+        self.outcomes = {model: list(script) for model, script in outcomes.items()}
+        self.calls = []
+        self.messages = SimpleNamespace(stream=self.stream)
+
+    def stream(self, model, **kwargs):
+        self.calls.append(model)
+        return FakeStream(self.outcomes[model].pop(0))
+
+
+class GenerateReplyTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.lookup = mock.AsyncMock(return_value=None)
+        self.store = mock.AsyncMock()
+        for patcher in (
+            mock.patch.object(ai_engine.semantic_cache, "lookup", self.lookup),
+            mock.patch.object(ai_engine.semantic_cache, "store", self.store),
+            mock.patch.object(ai_engine.random, "uniform", return_value=0),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.typing = mock.AsyncMock()
+
+    def use_client(self, **outcomes):
+        fake = FakeAnthropic(**outcomes)
+        patcher = mock.patch.object(ai_engine, "client", fake)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return fake
+
+    async def reply(self, message="What time do you open?", history=()):
+        result = await generate_reply(message, BUSINESS, list(history), on_first_token=self.typing)
+        await asyncio.sleep(0)  # let fire-and-forget callbacks run
+        return result
+
+    async def test_fast_model_answers_short_messages(self):
+        fake = self.use_client(**{FAST_MODEL: [["We open ", "at 8am."]]})
+
+        self.assertEqual(await self.reply(), ("We open at 8am.", False))
+        self.assertEqual(fake.calls, [FAST_MODEL])
+        self.typing.assert_awaited_once()
+        self.store.assert_awaited_once_with(BUSINESS.id, "What time do you open?", "We open at 8am.")
+
+    async def test_transient_error_is_retried_once(self):
+        fake = self.use_client(**{FAST_MODEL: [_status_error(OverloadedError, 529), ["At 8am."]]})
+
+        with self.assertLogs("ai_engine", "WARNING") as logs:
+            self.assertEqual(await self.reply(), ("At 8am.", False))
+        self.assertIn("retrying once", logs.output[0])
+        self.assertEqual(fake.calls, [FAST_MODEL, FAST_MODEL])
+
+    async def test_fast_model_error_falls_back_to_primary(self):
+        fake = self.use_client(
+            **{FAST_MODEL: [_status_error(NotFoundError, 404)], PRIMARY_MODEL: [["At 8am."]]}
+        )
+
+        with self.assertLogs("ai_engine", "WARNING"):
+            self.assertEqual(await self.reply(), ("At 8am.", False))
+        self.assertEqual(fake.calls, [FAST_MODEL, PRIMARY_MODEL])
+
+    async def test_exhausted_retries_fall_back_to_primary(self):
+        overloaded = _status_error(OverloadedError, 529)
+        fake = self.use_client(**{FAST_MODEL: [overloaded, overloaded], PRIMARY_MODEL: [["At 8am."]]})
+
+        with self.assertLogs("ai_engine", "WARNING"):
+            self.assertEqual(await self.reply(), ("At 8am.", False))
+        self.assertEqual(fake.calls, [FAST_MODEL, FAST_MODEL, PRIMARY_MODEL])
+
+    async def test_unsure_fast_reply_is_retried_on_primary_with_one_typing_hook(self):
+        fake = self.use_client(
+            **{FAST_MODEL: [["I'm not sure, sorry."]], PRIMARY_MODEL: [["We open at 8am."]]}
+        )
+
+        self.assertEqual(await self.reply(), ("We open at 8am.", False))
+        self.assertEqual(fake.calls, [FAST_MODEL, PRIMARY_MODEL])
+        self.typing.assert_awaited_once()
+
+    async def test_primary_model_errors_are_not_retried_on_fast(self):
+        fake = self.use_client(**{PRIMARY_MODEL: [_status_error(NotFoundError, 404)]})
+
+        with self.assertLogs("ai_engine", "ERROR"):
+            reply_text, needs_human = await self.reply("x" * (ai_engine.FAST_MODEL_MAX_CHARS + 1))
+
+        self.assertTrue(reply_text.startswith("Sorry"))
+        self.assertFalse(needs_human)
+        self.assertEqual(fake.calls, [PRIMARY_MODEL])
+        self.typing.assert_not_awaited()
+        self.store.assert_not_awaited()
+
+    async def test_needs_human_signal_hands_off(self):
+        self.use_client(
+            **{FAST_MODEL: [["NEEDS_HUMAN"]], PRIMARY_MODEL: [["NEEDS_", "HUMAN", " ignored"]]}
+        )
+
+        self.assertEqual(await self.reply(), (HANDOFF_MESSAGE, True))
+        self.store.assert_not_awaited()
+
+    async def test_cache_hit_skips_the_model(self):
+        self.lookup.return_value = "We open at 8am."
+        fake = self.use_client()
+
+        self.assertEqual(await self.reply(), ("We open at 8am.", False))
+        self.assertEqual(fake.calls, [])
+        self.typing.assert_not_awaited()
+
+    async def test_cache_is_bypassed_mid_conversation(self):
+        self.use_client(**{FAST_MODEL: [["At 8am."]]})
+        history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello!"}]
+
+        await self.reply(history=history)
+
+        self.lookup.assert_not_awaited()
+        self.store.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+import unittest
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+from sqlalchemy.dialects import postgresql
+
+from services import conversation_service
+from services.conversation_service import (
+    HISTORY_WINDOW,
+    SUMMARY_BATCH,
+    get_conversation_history_for_claude,
+    refresh_history_summary,
+)
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeSession:
+    """
+    Stands in for AsyncSession over one conversation's messages. Evaluates the
+    message queries built by conversation_service from their bound parameters
+    (conversation, roles, created_at lower bound, order and limit).
+    """
+
+    def __init__(self, conversation, messages):
+        self.conversation = conversation
+        self.messages = messages
+        self.commits = 0
+
+    async def get(self, model, ident):
+        return self.conversation if ident == self.conversation.id else None
+
+    async def execute(self, query):
+        compiled = query.compile(dialect=postgresql.dialect())
+        params = compiled.params
+        rows = [
+            msg for msg in self.messages
+            if msg.conversation_id == params["conversation_id_1"]
+            and msg.role in params["role_1"]
+            and ("created_at_1" not in params or msg.created_at > params["created_at_1"])
+        ]
+        rows.sort(key=lambda msg: msg.created_at, reverse="created_at DESC" in str(compiled))
+        rows = rows[:params["param_1"]]
+        columns = [column.key for column in query.selected_columns]
+        return SimpleNamespace(all=lambda: [
+            SimpleNamespace(**{key: getattr(msg, key) for key in columns}) for msg in rows
+        ])
+
+    async def commit(self):
+        self.commits += 1
+
+
+def _conversation(summary=None, until=None):
+    return SimpleNamespace(id=uuid.uuid4(), history_summary=summary, history_summary_until=until)
+
+
+def _messages(conversation, count, roles=("user", "assistant")):
+    return [
+        SimpleNamespace(
+            conversation_id=conversation.id,
+            role=roles[i % len(roles)],
+            content=f"m{i}",
+            created_at=T0 + timedelta(minutes=i),
+        )
+        for i in range(count)
+    ]
+
+
+class HistoryWindowTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_returns_latest_messages_oldest_first(self):
+        conversation = _conversation()
+        db = FakeSession(conversation, _messages(conversation, 30))
+
+        history = await get_conversation_history_for_claude(db, conversation, limit=20)
+
+        self.assertEqual([m["content"] for m in history], [f"m{i}" for i in range(10, 30)])
+        self.assertEqual(history[0]["role"], "user")
+
+    async def test_skips_system_messages(self):
+        conversation = _conversation()
+        messages = _messages(conversation, 6, roles=("user", "system", "assistant"))
+        db = FakeSession(conversation, messages)
+
+        history = await get_conversation_history_for_claude(db, conversation, limit=20)
+
+        self.assertEqual([m["content"] for m in history], ["m0", "m2", "m3", "m5"])
+
+    async def test_summary_takes_one_slot_and_hides_summarised_messages(self):
+        until = T0 + timedelta(minutes=24)
+        conversation = _conversation(summary="Asked about prices.", until=until)
+        db = FakeSession(conversation, _messages(conversation, 30))
+
+        history = await get_conversation_history_for_claude(db, conversation, limit=20)
+
+        self.assertEqual(history[0], {"role": "user", "content": "[Prior conversation summary]: Asked about prices."})
+        self.assertEqual([m["content"] for m in history[1:]], [f"m{i}" for i in range(25, 30)])
+
+    async def test_summary_with_full_window_stays_within_limit(self):
+        conversation = _conversation(summary="Earlier chat.", until=T0 - timedelta(minutes=1))
+        db = FakeSession(conversation, _messages(conversation, 30))
+
+        history = await get_conversation_history_for_claude(db, conversation, limit=20)
+
+        self.assertEqual(len(history), 20)
+        self.assertEqual(history[1]["content"], "m11")
+        self.assertEqual(history[-1]["content"], "m29")
+
+
+class RefreshHistorySummaryTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(
+            conversation_service, "summarize_history", mock.AsyncMock(return_value="New summary.")
+        )
+        self.summarize = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_window_alone_is_not_summarised(self):
+        conversation = _conversation()
+        db = FakeSession(conversation, _messages(conversation, HISTORY_WINDOW))
+
+        await refresh_history_summary(db, conversation.id)
+
+        self.summarize.assert_not_awaited()
+        self.assertIsNone(conversation.history_summary_until)
+        self.assertEqual(db.commits, 0)
+
+    async def test_folds_only_messages_older_than_window(self):
+        conversation = _conversation()
+        messages = _messages(conversation, HISTORY_WINDOW + 3)
+        db = FakeSession(conversation, messages)
+
+        await refresh_history_summary(db, conversation.id)
+
+        previous, folded = self.summarize.await_args.args
+        self.assertIsNone(previous)
+        self.assertEqual([m["content"] for m in folded], ["m0", "m1", "m2"])
+        self.assertEqual(conversation.history_summary, "New summary.")
+        self.assertEqual(conversation.history_summary_until, messages[2].created_at)
+        self.assertEqual(db.commits, 1)
+
+    async def test_backlog_is_folded_in_batches(self):
+        conversation = _conversation()
+        db = FakeSession(conversation, _messages(conversation, SUMMARY_BATCH + HISTORY_WINDOW + 5))
+
+        await refresh_history_summary(db, conversation.id)
+        self.assertEqual(len(self.summarize.await_args.args[1]), SUMMARY_BATCH)
+
+        await refresh_history_summary(db, conversation.id)
+        previous, folded = self.summarize.await_args.args
+        self.assertEqual(previous, "New summary.")
+        self.assertEqual([m["content"] for m in folded], [f"m{SUMMARY_BATCH + i}" for i in range(5)])
+
+        await refresh_history_summary(db, conversation.id)
+        self.assertEqual(self.summarize.await_count, 2)
+
+    async def test_history_after_refresh_is_summary_plus_window(self):
+        conversation = _conversation()
+        db = FakeSession(conversation, _messages(conversation, HISTORY_WINDOW + 7))
+
+        await refresh_history_summary(db, conversation.id)
+        history = await get_conversation_history_for_claude(db, conversation, limit=20)
+
+        self.assertEqual(history[0]["content"], "[Prior conversation summary]: New summary.")
+        self.assertEqual([m["content"] for m in history[1:]], [f"m{i}" for i in range(7, HISTORY_WINDOW + 7)])
+
+    async def test_unknown_conversation_is_ignored(self):
+        conversation = _conversation()
+        db = FakeSession(conversation, [])
+
+        await refresh_history_summary(db, uuid.uuid4())
+
+        self.summarize.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+import uuid
+from datetime import datetime, timezone
+
+from sqlalchemy.dialects import postgresql
+
+from services.conversation_service import conversation_list_query
+
+
+def _compile(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect()))
+
+
+class ConversationListQueryTest(unittest.TestCase):
+    """Nothing else exercises these statements before they reach Postgres."""
+
+    def test_compiles_with_lateral_joins(self):
+        sql = _compile(conversation_list_query(uuid.uuid4()))
+        self.assertIn("FROM conversations LEFT OUTER JOIN LATERAL", sql)
+        self.assertEqual(sql.count("LEFT OUTER JOIN LATERAL"), 2)
+        self.assertIn("ORDER BY conversations.last_message_at DESC, conversations.id DESC", sql)
+
+    def test_compiles_with_status_filter(self):
+        sql = _compile(conversation_list_query(uuid.uuid4(), status="needs_human"))
+        self.assertIn("conversations.status = ", sql)
+
+    def test_compiles_with_cursor(self):
+        after = (datetime.now(timezone.utc), uuid.uuid4())
+        sql = _compile(conversation_list_query(uuid.uuid4(), after=after))
+        self.assertIn("FROM conversations LEFT OUTER JOIN LATERAL", sql)
+        self.assertIn("(conversations.last_message_at, conversations.id) < (", sql)
+
+    def test_compiles_with_null_cursor(self):
+        sql = _compile(conversation_list_query(uuid.uuid4(), after=(None, uuid.uuid4())))
+        self.assertIn("conversations.last_message_at IS NULL AND conversations.id < ", sql)
+        self.assertIn("conversations.last_message_at IS NOT NULL", sql)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import unittest
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import IntegrityError
+
+import main
+from main import MAX_HISTORY_TURNS, _decode_cursor, _encode_cursor, process_message
+
+PHONE_NUMBER_ID = "1234567890"
+
+
+def _payload(text="What time do you open?", msg_type="text", msg_id="wamid.1"):
+    msg = {"id": msg_id, "type": msg_type, "from": "27820000000"}
+    if msg_type == "text":
+        msg["text"] = {"body": text}
+    return {"entry": [{"changes": [{"value": {
+        "metadata": {"phone_number_id": PHONE_NUMBER_ID},
+        "messages": [msg],
+    }}]}]}
+
+
+class FakeSession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class ProcessMessageTest(unittest.IsolatedAsyncioTestCase):
+    """process_message against fake DB services and fake Anthropic/WhatsApp calls."""
+
+    def setUp(self):
+        self.events = []
+        self.business = SimpleNamespace(
+            id=uuid.uuid4(), access_token="token", ai_enabled=True, catalogue_items=[]
+        )
+        self.conversation = SimpleNamespace(id=uuid.uuid4(), ai_handling=True)
+        self.history = []
+        self.reply = ("We open at 8am.", False)
+        self.stream_tokens = False
+
+        async def get_business_by_phone_id(db, phone_number_id):
+            self.events.append("load business")
+            return self.business
+
+        async def get_or_create_conversation(db, business_id, customer_number):
+            self.events.append("load conversation")
+            return self.conversation
+
+        async def get_conversation_history_for_claude(db, conversation, limit):
+            self.events.append("load history")
+            return self.history
+
+        async def save_message(db, conversation_id, role, content, **kwargs):
+            self.events.append(f"save {role}")
+
+        async def generate_reply(customer_message, business, history, catalogue_items, on_first_token):
+            self.events.append("generate reply")
+            if self.stream_tokens:
+                await on_first_token()
+            return self.reply
+
+        async def send_message(to, text, phone_number_id, access_token):
+            self.events.append("send reply")
+
+        async def mark_as_read(message_id, phone_number_id, access_token, typing=False):
+            self.events.append("typing" if typing else "mark read")
+
+        async def summarize_conversation(conversation_id):
+            self.events.append("summarize")
+
+        self.save_message = mock.AsyncMock(side_effect=save_message)
+        self.generate_reply = mock.AsyncMock(side_effect=generate_reply)
+        fakes = {
+            "AsyncSessionLocal": FakeSession,
+            "get_business_by_phone_id": get_business_by_phone_id,
+            "get_or_create_conversation": get_or_create_conversation,
+            "get_conversation_history_for_claude": get_conversation_history_for_claude,
+            "save_message": self.save_message,
+            "generate_reply": self.generate_reply,
+            "send_message": send_message,
+            "mark_as_read": mark_as_read,
+            "summarize_conversation": summarize_conversation,
+        }
+        for name, fake in fakes.items():
+            patcher = mock.patch.object(main, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_reply_flow_order(self):
+        self.stream_tokens = True
+
+        await process_message(_payload())
+
+        self.assertEqual(self.events, [
+            "load business",
+            "load conversation",
+            "load history",
+            "save user",
+            "generate reply",
+            "typing",
+            "save assistant",
+            "send reply",
+        ])
+        self.assertEqual(self.generate_reply.await_args.kwargs["history"], [])
+
+    async def test_read_receipt_sent_when_no_token_streams(self):
+        await process_message(_payload())
+
+        self.assertEqual(self.events[-3:], ["save assistant", "send reply", "mark read"])
+        self.assertNotIn("typing", self.events)
+
+    async def test_duplicate_delivery_is_ignored(self):
+        self.save_message.side_effect = IntegrityError("INSERT INTO messages", {}, Exception("duplicate key"))
+
+        with self.assertLogs("main", "INFO") as logs:
+            await process_message(_payload())
+
+        self.assertIn("Duplicate delivery of message wamid.1 ignored.", logs.output[0])
+        self.generate_reply.assert_not_awaited()
+        self.assertEqual(self.events, ["load business", "load conversation", "load history"])
+
+    async def test_full_history_window_triggers_summary_after_reply(self):
+        self.history = [{"role": "user", "content": "hi"}] * MAX_HISTORY_TURNS
+
+        await process_message(_payload())
+
+        self.assertEqual(self.events[-1], "summarize")
+        self.assertLess(self.events.index("send reply"), self.events.index("summarize"))
+
+    async def test_ai_disabled_only_marks_read(self):
+        self.conversation.ai_handling = False
+
+        await process_message(_payload())
+
+        self.assertEqual(self.events, ["load business", "load conversation", "save user", "mark read"])
+        self.generate_reply.assert_not_awaited()
+
+    async def test_empty_text_is_marked_read(self):
+        await process_message(_payload(text="   "))
+
+        self.assertEqual(self.events, ["load business", "mark read"])
+
+    async def test_media_gets_fallback_message(self):
+        await process_message(_payload(msg_type="image"))
+
+        self.assertEqual(self.events, ["load business", "send reply"])
+
+
+class ReceiveWebhookTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(main, "process_message", mock.AsyncMock())
+        self.process_message = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(main.app)
+
+    def test_acknowledges_and_processes_in_background(self):
+        response = self.client.post("/webhook", json=_payload())
+
+        self.assertEqual(response.status_code, 200)
+        self.process_message.assert_awaited_once_with(_payload())
+
+    def test_malformed_body_is_acknowledged_and_dropped(self):
+        response = self.client.post("/webhook", content=b"not json")
+
+        self.assertEqual(response.status_code, 200)
+        self.process_message.assert_not_awaited()
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        last_message_at = datetime(2025, 3, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+        conversation_id = uuid.uuid4()
+
+        self.assertEqual(
+            _decode_cursor(_encode_cursor(last_message_at, conversation_id)),
+            (last_message_at, conversation_id),
+        )
+
+    def test_round_trip_null_last_message_at(self):
+        conversation_id = uuid.uuid4()
+
+        self.assertEqual(_decode_cursor(_encode_cursor(None, conversation_id)), (None, conversation_id))
+
+    def test_cursor_is_url_safe(self):
+        cursor = _encode_cursor(datetime.now(timezone.utc), uuid.uuid4())
+
+        self.assertNotRegex(cursor, r"[+/]")
+
+    def test_invalid_cursors_are_rejected(self):
+        for cursor in ("zz!", "bm9waXBl", _encode_cursor(None, uuid.uuid4())[:-8]):
+            with self.subTest(cursor=cursor), self.assertRaises(HTTPException) as ctx:
+                _decode_cursor(cursor)
+            self.assertEqual(ctx.exception.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()